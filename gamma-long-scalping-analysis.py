@@ -1,8 +1,13 @@
 import math, time, copy
-import numpy as np, pandas as pd, matplotlib.pyplot as plt
+import numpy as np, pandas as pd
+from matplotlib.figure import Figure
+from greeks import Greeks
+from report import Report
 from loguru import logger
 from py_vollib.black_scholes import black_scholes as bs_price
 from py_vollib.black_scholes.greeks.analytical import delta as bs_delta
+from py_vollib.black_scholes.greeks.analytical import gamma as bs_gamma
+from py_vollib.black_scholes.greeks.analytical import vega as bs_vega
 
 class Option:
 
@@ -57,6 +62,46 @@ class Option:
                      self.vol)
             
         return _
+
+    @property
+    def gamma(self) -> float:
+
+        _ = bs_gamma(self.type, 
+                     self.S, 
+                     self.K, 
+                     self.ttm / self.DAYS_IN_YEAR, 
+                     self.r, 
+                     self.vol)
+            
+        return _
+
+    @property
+    def vega(self) -> float:
+
+        # py_vollib quotes vega per 1 vol point; scale it back to per unit of vol
+        _ = bs_vega(self.type, 
+                    self.S, 
+                    self.K, 
+                    self.ttm / self.DAYS_IN_YEAR, 
+                    self.r, 
+                    self.vol) * 100
+            
+        return _
+
+    @property
+    def vanna(self) -> float:
+
+        # d(delta)/d(vol), identical for calls and puts
+        t = self.ttm / self.DAYS_IN_YEAR
+
+        if t <= 0:
+            return 0.0
+
+        d1 = (math.log(self.S / self.K) + (self.r + 0.5 * self.vol ** 2) * t) / (self.vol * math.sqrt(t))
+        d2 = d1 - self.vol * math.sqrt(t)
+        _ = -math.exp(-0.5 * d1 ** 2) / math.sqrt(2 * math.pi) * d2 / self.vol
+
+        return _
     
 class Portfolio:
 
@@ -71,16 +116,36 @@ class Portfolio:
         self.call = call
         self.put = put
         self.trigger = trigger
+        self.reset()
+
+    def reset(self) -> None:
+
+        # (re)builds the initial position from the legs and trigger, e.g. after bumping them
+        call, put = self.call, self.put
         self.option_price = call.price + put.price
         self.option_delta = call.delta + put.delta
         self.perp_delta = 0
         self.total_delta = self.option_delta + self.perp_delta
         self.pnl = 0
 
+        # pathwise tangents: *_dvol w.r.t. the options' implied vol (same bump on every leg),
+        # *_dsv w.r.t. the simulated spot vol (carried by the spot tangent spot_dsv)
+        self.spot_dsv = 0
+        self.option_price_dvol = call.vega + put.vega
+        self.option_price_dsv = 0
+        self.option_delta_dvol = call.vanna + put.vanna
+        self.option_delta_dsv = 0
+        self.perp_delta_dvol = 0
+        self.perp_delta_dsv = 0
+        self.pnl_dvol = 0
+        self.pnl_dsv = 0
+
         self.__delta_adjust(old_spot=self.call.S, 
                             new_spot=self.call.S,
                             old_delta=self.option_delta,
-                            new_delta=self.total_delta)
+                            new_delta=self.total_delta,
+                            old_spot_dsv=0.0,
+                            new_spot_dsv=0.0)
 
 
     def __str__(self) -> str:
@@ -102,12 +167,13 @@ class Portfolio:
 
         return _
 
-    def reval(self, new_spot:float, new_ttm:float) -> None:
+    def reval(self, new_spot:float, new_ttm:float, spot_dsv:float|None=None) -> None:
         
         logger.remove()
 
         old_spot = self.call.S
         old_total_delta = self.total_delta
+        old_spot_dsv = self.spot_dsv
         
         logger.info(f"Old spot = {self.call.S:.2f}")
         logger.info(f"New spot = {new_spot:.2f}")
@@ -133,14 +199,37 @@ class Portfolio:
 
         self.option_delta = self.call.delta + self.put.delta
         self.total_delta = self.option_delta + self.perp_delta
-        self.__delta_adjust(old_spot=old_spot, new_spot=new_spot, old_delta=old_total_delta, new_delta=self.option_delta)
+
+        if spot_dsv is not None:
+            self.__reval_tangents(spot_dsv=spot_dsv)
+
+        self.__delta_adjust(old_spot=old_spot, new_spot=new_spot, old_delta=old_total_delta, new_delta=self.option_delta,
+                            old_spot_dsv=None if spot_dsv is None else old_spot_dsv,
+                            new_spot_dsv=spot_dsv)
 
         logger.info(f"New option delta = {self.option_delta * 100:.2f}%")
         logger.info(f"New perp delta = {self.perp_delta * 100:.2f}%")
         logger.info(f"New total delta = {self.total_delta * 100:.2f}%")
 
 
-    def __delta_adjust(self, old_spot:float, new_spot:float, old_delta:float, new_delta:float) -> None:
+    def __reval_tangents(self, spot_dsv:float) -> None:
+
+        # called after the spot/ttm update, differentiates the option leg of reval()
+        option_delta_dsv = (self.call.gamma + self.put.gamma) * spot_dsv
+        new_option_price_dvol = self.call.vega + self.put.vega
+        new_option_price_dsv = self.option_delta * spot_dsv
+
+        self.pnl_dvol = self.pnl_dvol + (new_option_price_dvol - self.option_price_dvol)
+        self.pnl_dsv = self.pnl_dsv + (new_option_price_dsv - self.option_price_dsv)
+
+        self.spot_dsv = spot_dsv
+        self.option_price_dvol = new_option_price_dvol
+        self.option_price_dsv = new_option_price_dsv
+        self.option_delta_dvol = self.call.vanna + self.put.vanna
+        self.option_delta_dsv = option_delta_dsv
+
+    def __delta_adjust(self, old_spot:float, new_spot:float, old_delta:float, new_delta:float,
+                       old_spot_dsv:float|None=None, new_spot_dsv:float|None=None) -> None:
 
         logger.remove()
 
@@ -157,6 +246,14 @@ class Portfolio:
             logger.info(f"Variation of P&L due to delta adjustment: {(new_spot - old_spot) * self.perp_delta:.2f}")
             
             self.pnl = self.pnl + (new_spot - old_spot) * self.perp_delta
+
+            if old_spot_dsv is not None and new_spot_dsv is not None:
+                self.pnl_dvol = self.pnl_dvol + (new_spot - old_spot) * self.perp_delta_dvol
+                self.pnl_dsv = self.pnl_dsv + (new_spot - old_spot) * self.perp_delta_dsv \
+                                            + (new_spot_dsv - old_spot_dsv) * self.perp_delta
+                self.perp_delta_dvol = -self.option_delta_dvol
+                self.perp_delta_dsv = -self.option_delta_dsv
+
             self.perp_delta = -new_delta
             self.total_delta = self.option_delta + self.perp_delta
 
@@ -182,6 +279,7 @@ class Simulation:
         self.__initial_cost = self.__original_portfolio.option_price
         self.__simulated_pnl = None
         self.__simulated_roi = None
+        self.__greeks = None
 
     def __str__(self) -> str:
 
@@ -221,51 +319,137 @@ class Simulation:
         print(f"  - ROI = {(portfolio.pnl / self.__initial_cost)*100:.2f}%")
         print("-----------------------------------------------------------------")
 
-    def run(self, spot:float, repeat:int, display:bool) -> None:
+    # greeks=True adds ~6 Black-Scholes calls per step for the pathwise tangents, and every parameter
+    # in bump costs two extra full-path revaluations per path (only the trigger by default)
+    def run(self, spot:float, repeat:int, display:bool, greeks:bool=False, bump:tuple[str, ...]=("trigger",), 
+            report:Report|None=None, keep_paths:bool=True) -> None:
+
+        self.__greeks = None
+        sensitivities = None
+
+        if greeks:
+            sensitivities = Greeks(spot_vol=self.__spot_vol, 
+                                   trigger=self.__original_portfolio.trigger,
+                                   initial_cost=self.__initial_cost,
+                                   initial_vega=self.__original_portfolio.option_price_dvol,
+                                   bump=bump)
 
         print("=================================================================")
         print("Simulation started")
         
-        ttm_decrement = self.__ttm_days / self.__estimated_number_of_points
         nvol = self.__spot_vol * math.sqrt(self.__polling_minutes/self.MINUTES_IN_YEAR)
 
         simulated_pnl = []
         simulated_roi = []
+        trace = None
+
+        if report is not None:
+            fan_steps = set(report.open(n_steps=self.__estimated_number_of_points, 
+                                        step_days=self.__ttm_days / self.__estimated_number_of_points).tolist())
 
         start_time = time.time()
+        last_print = -math.inf
+
+        try:
+            for _ in range(repeat):
+
+                end_time = time.time()
+                elapsed_time = end_time - start_time
+
+                # at most one progress line per second, even on very large runs
+                if end_time - last_print >= 1.0:
+                    print(f"Execution time: {elapsed_time:.2f} seconds | paths: {_:,}/{repeat:,}", end='\r')
+                    last_print = end_time
+
+                portfolio = copy.deepcopy(self.__original_portfolio)
+                log_rets = np.random.normal(loc=0.0, scale=nvol, size=self.__estimated_number_of_points)
+        
+                if report is not None:
+                    trace = []
+
+                portfolio = self.__revalue_path(portfolio=portfolio, spot=spot, log_rets=log_rets, pathwise=greeks,
+                                                trace_steps=fan_steps if report is not None else None, trace=trace)
+                roi = portfolio.pnl / self.__initial_cost
+
+                if keep_paths:
+                    simulated_pnl.append(portfolio.pnl)
+                    simulated_roi.append(roi)
 
-        for _ in range(repeat):
+                if report is not None:
+                    report.add(pnl=portfolio.pnl, roi=roi, step_roi=np.array(trace) / self.__initial_cost)
+
+                if greeks:
+                    sensitivities.add(pnl=portfolio.pnl, log_rets=log_rets, nvol=nvol,
+                                      pathwise_dsv=portfolio.pnl_dsv, pathwise_dvol=portfolio.pnl_dvol,
+                                      revalue=lambda name, h: self.__bumped_path(name=name, bump=h, spot=spot, log_rets=log_rets))
+            
+                if display:
+                    print(f"Iteration #{_}: P&L = {portfolio.pnl:.2f} | ROI = {roi:.2f}")
 
             end_time = time.time()
             elapsed_time = end_time - start_time
-            print(f"Execution time: {elapsed_time:.2f} seconds", end='\r')
+            print(f"Execution time: {elapsed_time:.2f} seconds")
 
-            portfolio = copy.deepcopy(self.__original_portfolio)
-            local_ttm = self.__ttm_days
-            local_spot = spot
-            log_rets = np.random.normal(loc=0.0, scale=nvol, size=self.__estimated_number_of_points)
-        
-            print(f"self.__estimated_number_of_points = {self.__estimated_number_of_points}")
-            for _, lr in enumerate(log_rets):
-                # print(f"{_}")
-                local_spot = local_spot * math.exp(lr)
-                local_ttm = local_ttm - ttm_decrement
+        finally:
+            # a failed simulation still gets its last render
+            if report is not None:
+                report.close()
+
+        self.__simulated_pnl = simulated_pnl if keep_paths else None
+        self.__simulated_roi = simulated_roi if keep_paths else None
+
+        self.__greeks = sensitivities
+
+    def __revalue_path(self, portfolio:Portfolio, spot:float, log_rets:np.ndarray, pathwise:bool=False,
+                       trace_steps:set|None=None, trace:list|None=None) -> Portfolio:
+
+        ttm_decrement = self.__ttm_days / self.__estimated_number_of_points
+        local_ttm = self.__ttm_days
+        local_spot = spot
+        cum_log_ret = 0.0
+
+        for k, lr in enumerate(log_rets):
+            local_spot = local_spot * math.exp(lr)
+            local_ttm = local_ttm - ttm_decrement
+
+            if pathwise:
+                # S_k = S_0 * exp(sum(lr)) and every lr scales with spot_vol
+                cum_log_ret = cum_log_ret + lr
+                portfolio.reval(new_spot=local_spot, new_ttm=local_ttm, spot_dsv=local_spot * cum_log_ret / self.__spot_vol)
+            else:
                 portfolio.reval(new_spot=local_spot, new_ttm=local_ttm)
 
-            simulated_pnl.append(portfolio.pnl)
-            simulated_roi.append(portfolio.pnl / self.__initial_cost)
-            
-            if display:
-                print(f"Iteration #{_}: P&L = {portfolio.pnl:.2f} | ROI = {simulated_roi[_]:.2f}")
+            if trace_steps is not None and k in trace_steps:
+                trace.append(portfolio.pnl)
+
+        return portfolio
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Execution time: {elapsed_time:.2f} seconds")
+    def __bumped_path(self, name:str, bump:float, spot:float, log_rets:np.ndarray) -> tuple[float, float]:
 
-        self.__simulated_pnl = simulated_pnl
-        self.__simulated_roi = simulated_roi
+        portfolio = copy.deepcopy(self.__original_portfolio)
+
+        if name == "spot_vol":
+            log_rets = log_rets * (self.__spot_vol + bump) / self.__spot_vol
+        elif name == "vol":
+            portfolio.call.vol = portfolio.call.vol + bump
+            portfolio.put.vol = portfolio.put.vol + bump
+            portfolio.reset()
+        elif name == "trigger":
+            portfolio.trigger = portfolio.trigger + bump
+            portfolio.reset()
+        else:
+            raise ValueError(f"Simulation: unknown parameter '{name}'")
+
+        initial_cost = portfolio.option_price
+        portfolio = self.__revalue_path(portfolio=portfolio, spot=spot, log_rets=log_rets)
+
+        return portfolio.pnl, portfolio.pnl / initial_cost
+
+    def summarize_roi(self, out_file:str="roi_histogram.png") -> None:
+
+        if self.__simulated_pnl is None:
+            raise RuntimeError("Simulation: no per-path results kept, use run(..., keep_paths=True) or a Report")
 
-    def summarize_roi(self) -> None:
         df = pd.DataFrame({"P&L":self.__simulated_pnl, "ROI %": self.__simulated_roi})
         df["ROI %"] = df["ROI %"] * 100
         print("-----------------------------------------------------------------")
@@ -273,11 +457,21 @@ class Simulation:
         print("-----------------------------------------------------------------")
         print(df.describe())
         print("-----------------------------------------------------------------")
-        plt.hist(df['ROI %'], bins=15, edgecolor='black')
-        plt.title('Histograma de Retornos')
-        plt.xlabel('Retorno')
-        plt.ylabel('Frequência')
-        plt.show()
+        fig = Figure(figsize=(8, 5))
+        ax = fig.add_subplot()
+        ax.hist(df['ROI %'], bins=15, edgecolor='black')
+        ax.set_title('Histograma de Retornos')
+        ax.set_xlabel('Retorno')
+        ax.set_ylabel('Frequência')
+        fig.savefig(out_file)
+        print(f"Histogram saved to {out_file}")
+
+    def summarize_greeks(self) -> None:
+
+        if self.__greeks is None:
+            raise RuntimeError("Simulation: call run(..., greeks=True) before summarize_greeks()")
+
+        self.__greeks.summarize()
 
 if __name__ == "__main__":
 
@@ -288,5 +482,6 @@ if __name__ == "__main__":
 
     s = Simulation(portfolio=p, spot_vol=0.72, ttm_days=30, polling_minutes=5)
     # print(s)
-    s.run(spot = 200, repeat=1000, display=False)
-    s.summarize_roi()
+    r = Report(out_dir="reports/gamma-long")
+    s.run(spot = 200, repeat=1000, display=False, report=r, keep_paths=False)
+    r.summarize()
@@ -1,8 +1,13 @@
 import math, copy, time
-import numpy as np, pandas as pd, matplotlib.pyplot as plt
+import numpy as np, pandas as pd
+from matplotlib.figure import Figure
+from greeks import Greeks
+from report import Report
 from loguru import logger
 from py_vollib.black_scholes import black_scholes as bs_price
 from py_vollib.black_scholes.greeks.analytical import delta as bs_delta
+from py_vollib.black_scholes.greeks.analytical import gamma as bs_gamma
+from py_vollib.black_scholes.greeks.analytical import vega as bs_vega
 
 
 class Option:
@@ -62,6 +67,46 @@ class Option:
         # logger.info(f"Type = {self.type} | S = {self.S:.2f} | K = {self.K:.2f} | tmm = {self.ttm/self.DAYS_IN_YEAR:.4f} | delta = {_*100:.2f}%")
 
         return _
+
+    @property
+    def gamma(self) -> float:
+
+        _ = bs_gamma(self.type, 
+                     self.S, 
+                     self.K, 
+                     self.ttm / self.DAYS_IN_YEAR, 
+                     self.r, 
+                     self.vol)
+            
+        return _
+
+    @property
+    def vega(self) -> float:
+
+        # py_vollib quotes vega per 1 vol point; scale it back to per unit of vol
+        _ = bs_vega(self.type, 
+                    self.S, 
+                    self.K, 
+                    self.ttm / self.DAYS_IN_YEAR, 
+                    self.r, 
+                    self.vol) * 100
+            
+        return _
+
+    @property
+    def vanna(self) -> float:
+
+        # d(delta)/d(vol), identical for calls and puts
+        t = self.ttm / self.DAYS_IN_YEAR
+
+        if t <= 0:
+            return 0.0
+
+        d1 = (math.log(self.S / self.K) + (self.r + 0.5 * self.vol ** 2) * t) / (self.vol * math.sqrt(t))
+        d2 = d1 - self.vol * math.sqrt(t)
+        _ = -math.exp(-0.5 * d1 ** 2) / math.sqrt(2 * math.pi) * d2 / self.vol
+
+        return _
     
 class Portfolio:
 
@@ -77,16 +122,40 @@ class Portfolio:
         self.call_b = call_b
         self.put_b = put_b
         self.trigger = trigger
+        self.reset()
+
+    def reset(self) -> None:
+
+        # (re)builds the initial position from the legs and trigger, e.g. after bumping them
+        call_s, call_b, put_s, put_b = self.call_s, self.call_b, self.put_s, self.put_b
         self.option_price = -call_s.price + call_b.price - put_s.price + put_b.price
         self.option_delta = -call_s.delta - put_s.delta + call_b.delta + put_b.delta
         self.perp_delta = 0
         self.total_delta = self.option_delta + self.perp_delta
         self.pnl = 0
 
+        # pathwise tangents: *_dvol w.r.t. the options' implied vol (same bump on every leg),
+        # *_dsv w.r.t. the simulated spot vol (carried by the spot tangent spot_dsv)
+        self.spot_dsv = 0
+        self.option_price_dvol = self.__signed_sum("vega")
+        self.option_price_dsv = 0
+        self.option_delta_dvol = self.__signed_sum("vanna")
+        self.option_delta_dsv = 0
+        self.perp_delta_dvol = 0
+        self.perp_delta_dsv = 0
+        self.total_delta_dvol = self.option_delta_dvol
+        self.total_delta_dsv = 0
+        self.pnl_dvol = 0
+        self.pnl_dsv = 0
+
         self.__delta_adjust(old_spot=self.call_s.S, 
                             new_spot=self.call_s.S,
                             old_delta=self.option_delta,
-                            new_delta=self.total_delta)
+                            new_delta=self.total_delta,
+                            old_spot_dsv=0.0,
+                            new_spot_dsv=0.0,
+                            old_delta_dvol=self.total_delta_dvol,
+                            old_delta_dsv=0.0)
 
         
     def __str__(self) -> str:
@@ -116,10 +185,13 @@ class Portfolio:
 
         return _
 
-    def reval(self, new_spot:float, new_ttm:float) -> None:
+    def reval(self, new_spot:float, new_ttm:float, spot_dsv:float|None=None) -> None:
         
         old_spot = self.call_s.S
         old_total_delta = self.total_delta
+        old_spot_dsv = self.spot_dsv
+        old_total_delta_dvol = self.total_delta_dvol
+        old_total_delta_dsv = self.total_delta_dsv
 
         self.call_s.S = new_spot
         self.call_b.S = new_spot
@@ -148,14 +220,49 @@ class Portfolio:
 
         self.option_delta = -self.call_s.delta - self.put_s.delta + self.call_b.delta + self.put_b.delta
         self.total_delta = self.option_delta + self.perp_delta
-        self.__delta_adjust(old_spot=old_spot, new_spot=new_spot, old_delta=old_total_delta, new_delta=self.option_delta)
+
+        if spot_dsv is not None:
+            self.__reval_tangents(spot_dsv=spot_dsv)
+
+        self.__delta_adjust(old_spot=old_spot, new_spot=new_spot, old_delta=old_total_delta, new_delta=self.option_delta,
+                            old_spot_dsv=None if spot_dsv is None else old_spot_dsv,
+                            new_spot_dsv=spot_dsv,
+                            old_delta_dvol=old_total_delta_dvol,
+                            old_delta_dsv=old_total_delta_dsv)
 
         logger.info(f"New option delta = {self.option_delta * 100:.2f}%")
         logger.info(f"New perp delta = {self.perp_delta * 100:.2f}%")
         logger.info(f"New total delta = {self.total_delta * 100:.2f}%")
 
 
-    def __delta_adjust(self, old_spot:float, new_spot:float, old_delta:float, new_delta:float) -> None:
+    def __signed_sum(self, greek:str) -> float:
+
+        # sold legs count negative, bought legs positive
+        _ = -getattr(self.call_s, greek) + getattr(self.call_b, greek) - getattr(self.put_s, greek) + getattr(self.put_b, greek)
+
+        return _
+
+    def __reval_tangents(self, spot_dsv:float) -> None:
+
+        # called after the spot/ttm update, differentiates the option leg of reval()
+        option_delta_dsv = self.__signed_sum("gamma") * spot_dsv
+        new_option_price_dvol = self.__signed_sum("vega")
+        new_option_price_dsv = self.option_delta * spot_dsv
+
+        self.pnl_dvol = self.pnl_dvol + (new_option_price_dvol - self.option_price_dvol)
+        self.pnl_dsv = self.pnl_dsv + (new_option_price_dsv - self.option_price_dsv)
+
+        self.spot_dsv = spot_dsv
+        self.option_price_dvol = new_option_price_dvol
+        self.option_price_dsv = new_option_price_dsv
+        self.option_delta_dvol = self.__signed_sum("vanna")
+        self.option_delta_dsv = option_delta_dsv
+        self.total_delta_dvol = self.option_delta_dvol + self.perp_delta_dvol
+        self.total_delta_dsv = self.option_delta_dsv + self.perp_delta_dsv
+
+    def __delta_adjust(self, old_spot:float, new_spot:float, old_delta:float, new_delta:float,
+                       old_spot_dsv:float|None=None, new_spot_dsv:float|None=None,
+                       old_delta_dvol:float=0.0, old_delta_dsv:float=0.0) -> None:
 
         logger.info("Portfolio.__delta_adjust()")
         logger.info(f"Accumulated P&L: {self.pnl:.2f}")
@@ -170,6 +277,16 @@ class Portfolio:
             logger.info(f"Variation of P&L due to delta adjustment: {(new_spot - old_spot) * old_delta:.2f}")
             
             self.pnl = self.pnl + (new_spot - old_spot) * old_delta
+
+            if old_spot_dsv is not None and new_spot_dsv is not None:
+                self.pnl_dvol = self.pnl_dvol + (new_spot - old_spot) * old_delta_dvol
+                self.pnl_dsv = self.pnl_dsv + (new_spot - old_spot) * old_delta_dsv \
+                                            + (new_spot_dsv - old_spot_dsv) * old_delta
+                self.perp_delta_dvol = self.option_delta_dvol
+                self.perp_delta_dsv = self.option_delta_dsv
+                self.total_delta_dvol = self.option_delta_dvol + self.perp_delta_dvol
+                self.total_delta_dsv = self.option_delta_dsv + self.perp_delta_dsv
+
             self.perp_delta = new_delta
             self.total_delta = self.option_delta + self.perp_delta
 
@@ -195,6 +312,7 @@ class Simulation:
         self.__initial_cost = self.__original_portfolio.option_price
         self.__simulated_pnl = None
         self.__simulated_roi = None
+        self.__greeks = None
 
     def __str__(self) -> str:
 
@@ -205,7 +323,20 @@ class Simulation:
 
         return _
 
-    def run(self, spot:float, repeat:int, display:bool) -> None:
+    # greeks=True adds ~12 Black-Scholes calls per step for the pathwise tangents, and every parameter
+    # in bump costs two extra full-path revaluations per path (only the trigger by default)
+    def run(self, spot:float, repeat:int, display:bool, greeks:bool=False, bump:tuple[str, ...]=("trigger",), 
+            report:Report|None=None, keep_paths:bool=True) -> None:
+
+        self.__greeks = None
+        sensitivities = None
+
+        if greeks:
+            sensitivities = Greeks(spot_vol=self.__spot_vol, 
+                                   trigger=self.__original_portfolio.trigger,
+                                   initial_cost=self.__initial_cost,
+                                   initial_vega=self.__original_portfolio.option_price_dvol,
+                                   bump=bump)
 
         print("=================================================================")
         print("Simulation started")
@@ -215,40 +346,115 @@ class Simulation:
 
         simulated_pnl = []
         simulated_roi = []
+        trace = None
+
+        if report is not None:
+            fan_steps = set(report.open(n_steps=self.__estimated_number_of_points, step_days=ttm_decrement).tolist())
 
         start_time = time.time()
+        last_print = -math.inf
+
+        try:
+            for _ in range(repeat):
+
+                end_time = time.time()
+                elapsed_time = end_time - start_time
 
-        for _ in range(repeat):
+                # at most one progress line per second, even on very large runs
+                if end_time - last_print >= 1.0:
+                    print(f"Execution time: {elapsed_time:.2f} seconds | paths: {_:,}/{repeat:,}", end='\r')
+                    last_print = end_time
+
+                portfolio = copy.deepcopy(self.__original_portfolio)
+                log_rets = np.random.normal(loc=0.0, scale=nvol, size=self.__estimated_number_of_points)
+        
+                if report is not None:
+                    trace = []
+
+                portfolio = self.__revalue_path(portfolio=portfolio, spot=spot, log_rets=log_rets, pathwise=greeks,
+                                                trace_steps=fan_steps if report is not None else None, trace=trace)
+                roi = portfolio.pnl / self.__initial_cost
+
+                if keep_paths:
+                    simulated_pnl.append(portfolio.pnl)
+                    simulated_roi.append(roi)
+
+                if report is not None:
+                    report.add(pnl=portfolio.pnl, roi=roi, step_roi=np.array(trace) / self.__initial_cost)
+
+                if greeks:
+                    sensitivities.add(pnl=portfolio.pnl, log_rets=log_rets, nvol=nvol,
+                                      pathwise_dsv=portfolio.pnl_dsv, pathwise_dvol=portfolio.pnl_dvol,
+                                      revalue=lambda name, h: self.__bumped_path(name=name, bump=h, spot=spot, log_rets=log_rets))
+            
+                if display:
+                    print(f"Iteration #{_}: P&L = {portfolio.pnl:.2f} | ROI = {roi:.2f}")
 
             end_time = time.time()
             elapsed_time = end_time - start_time
-            print(f"Execution time: {elapsed_time:.2f} seconds", end='\r')
+            print(f"Execution time: {elapsed_time:.2f} seconds")
 
-            portfolio = copy.deepcopy(self.__original_portfolio)
-            local_ttm = self.__ttm_days
-            local_spot = spot
-            log_rets = np.random.normal(loc=0.0, scale=nvol, size=self.__estimated_number_of_points)
-        
-            for lr in log_rets:
-                local_spot = local_spot * math.exp(lr)
-                local_ttm = local_ttm - ttm_decrement
+        finally:
+            # a failed simulation still gets its last render
+            if report is not None:
+                report.close()
+
+        self.__simulated_pnl = simulated_pnl if keep_paths else None
+        self.__simulated_roi = simulated_roi if keep_paths else None
+
+        self.__greeks = sensitivities
+
+    def __revalue_path(self, portfolio:Portfolio, spot:float, log_rets:np.ndarray, pathwise:bool=False,
+                       trace_steps:set|None=None, trace:list|None=None) -> Portfolio:
+
+        ttm_decrement = self.__ttm_days / self.__estimated_number_of_points
+        local_ttm = self.__ttm_days
+        local_spot = spot
+        cum_log_ret = 0.0
+
+        for k, lr in enumerate(log_rets):
+            local_spot = local_spot * math.exp(lr)
+            local_ttm = local_ttm - ttm_decrement
+
+            if pathwise:
+                # S_k = S_0 * exp(sum(lr)) and every lr scales with spot_vol
+                cum_log_ret = cum_log_ret + lr
+                portfolio.reval(new_spot=local_spot, new_ttm=local_ttm, spot_dsv=local_spot * cum_log_ret / self.__spot_vol)
+            else:
                 portfolio.reval(new_spot=local_spot, new_ttm=local_ttm)
-                # print(portfolio)
+            # print(portfolio)
 
-            simulated_pnl.append(portfolio.pnl)
-            simulated_roi.append(portfolio.pnl / self.__initial_cost)
-            
-            if display:
-                print(f"Iteration #{_}: P&L = {portfolio.pnl:.2f} | ROI = {simulated_roi[_]:.2f}")
+            if trace_steps is not None and k in trace_steps:
+                trace.append(portfolio.pnl)
+
+        return portfolio
+
+    def __bumped_path(self, name:str, bump:float, spot:float, log_rets:np.ndarray) -> tuple[float, float]:
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Execution time: {elapsed_time:.2f} seconds")
+        portfolio = copy.deepcopy(self.__original_portfolio)
 
-        self.__simulated_pnl = simulated_pnl
-        self.__simulated_roi = simulated_roi
+        if name == "spot_vol":
+            log_rets = log_rets * (self.__spot_vol + bump) / self.__spot_vol
+        elif name == "vol":
+            for option in [portfolio.call_s, portfolio.call_b, portfolio.put_s, portfolio.put_b]:
+                option.vol = option.vol + bump
+            portfolio.reset()
+        elif name == "trigger":
+            portfolio.trigger = portfolio.trigger + bump
+            portfolio.reset()
+        else:
+            raise ValueError(f"Simulation: unknown parameter '{name}'")
+
+        initial_cost = portfolio.option_price
+        portfolio = self.__revalue_path(portfolio=portfolio, spot=spot, log_rets=log_rets)
+
+        return portfolio.pnl, portfolio.pnl / initial_cost
+
+    def summarize_roi(self, out_file:str="roi_histogram.png") -> None:
+
+        if self.__simulated_pnl is None:
+            raise RuntimeError("Simulation: no per-path results kept, use run(..., keep_paths=True) or a Report")
 
-    def summarize_roi(self) -> None:
         df = pd.DataFrame({"P&L":self.__simulated_pnl, "ROI %": self.__simulated_roi})
         df["ROI %"] = df["ROI %"] * 100
         print("-----------------------------------------------------------------")
@@ -256,11 +462,21 @@ class Simulation:
         print("-----------------------------------------------------------------")
         print(df.describe())
         print("-----------------------------------------------------------------")
-        plt.hist(df['ROI %'], bins=15, edgecolor='black')
-        plt.title('Histograma de Retornos')
-        plt.xlabel('Retorno')
-        plt.ylabel('Frequência')
-        plt.show()
+        fig = Figure(figsize=(8, 5))
+        ax = fig.add_subplot()
+        ax.hist(df['ROI %'], bins=15, edgecolor='black')
+        ax.set_title('Histograma de Retornos')
+        ax.set_xlabel('Retorno')
+        ax.set_ylabel('Frequência')
+        fig.savefig(out_file)
+        print(f"Histogram saved to {out_file}")
+
+    def summarize_greeks(self) -> None:
+
+        if self.__greeks is None:
+            raise RuntimeError("Simulation: call run(..., greeks=True) before summarize_greeks()")
+
+        self.__greeks.summarize()
 
 if __name__ == "__main__":
 
@@ -272,5 +488,6 @@ if __name__ == "__main__":
     p = Portfolio(call_s=call_s, call_b=call_b, put_s=put_s, put_b=put_b, trigger=0.1)
 
     s = Simulation(portfolio=p, spot_vol=0.50, ttm_days=30, polling_minutes=5)
-    s.run(spot = 3800, repeat=100, display=False)
-    s.summarize_roi()
+    r = Report(out_dir="reports/gamma-short")
+    s.run(spot = 3800, repeat=100, display=False, report=r, keep_paths=False)
+    r.summarize()
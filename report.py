@@ -0,0 +1,254 @@
+import math, time, os, queue, threading
+import numpy as np
+from matplotlib.figure import Figure
+
+
+class Report:
+
+    QUANTILES = [0.01, 0.05, 0.25, 0.50, 0.75, 0.95, 0.99]
+    FAN_BANDS = [(0.05, 0.95), (0.25, 0.75)]
+    MAX_DISPLAY_BINS = 50
+    QUEUE_SIZE = 1024
+
+    def __init__(self, out_dir:str, roi_range:tuple[float, float]=(-200.0, 400.0), bin_width:float=0.5, 
+                 fan_points:int=50, render_every:float=30.0) -> None:
+
+        if roi_range[0] >= roi_range[1] or bin_width <= 0:
+            raise ValueError("Report: roi_range must be increasing and bin_width positive")
+
+        self.out_dir = out_dir
+        self.fan_points = fan_points
+        self.render_every = render_every
+        self.fan_steps = None
+
+        # ROI % is pre-binned on a fixed grid; values outside roi_range land in the edge bins
+        self.__edges = np.arange(roi_range[0], roi_range[1] + bin_width, bin_width)
+        self.__step_days = None
+        self.__reset(n_fan_steps=0)
+
+        self.__queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.__thread = None
+        self.__error = None
+
+    def open(self, n_steps:int, step_days:float) -> np.ndarray:
+
+        if self.__thread is not None:
+            raise RuntimeError("Report: already open, close() it before the next run")
+
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        # every run starts from empty statistics, so reusing a Report never mixes two runs
+        self.fan_steps = np.unique(np.linspace(0, n_steps - 1, min(self.fan_points, n_steps)).astype(int))
+        self.__step_days = step_days
+        self.__error = None
+        self.__reset(n_fan_steps=len(self.fan_steps))
+
+        self.__thread = threading.Thread(target=self.__worker, name="report", daemon=True)
+        self.__thread.start()
+
+        return self.fan_steps
+
+    def add(self, pnl:float, roi:float, step_roi:np.ndarray) -> None:
+
+        self.__put((pnl, roi, step_roi))
+
+    def close(self) -> None:
+
+        if self.__thread is None:
+            return
+
+        if self.__error is None:
+            self.__put(None)
+
+        self.__thread.join()
+        self.__thread = None
+
+        if self.__error is not None:
+            raise self.__error
+
+    def summarize(self) -> None:
+
+        print("-----------------------------------------------------------------")
+        print(f"Simulation summary (report in {self.out_dir})")
+        print("-----------------------------------------------------------------")
+
+        for k, v in self.__summary_rows():
+            print(f"{k:<28}{v:>20}")
+
+        print("-----------------------------------------------------------------")
+
+    def __reset(self, n_fan_steps:int) -> None:
+
+        self.__roi_hist = np.zeros(len(self.__edges) - 1, dtype=np.int64)
+        self.__fan_hist = np.zeros((n_fan_steps, len(self.__roi_hist)), dtype=np.int64)
+        self.__out_of_range = 0
+        self.__pnl_moments = np.zeros(3)        # n, sum, sum of squares
+        self.__roi_moments = np.zeros(3)
+        self.__pnl_min, self.__pnl_max = math.inf, -math.inf
+
+    def __put(self, item:tuple|None) -> None:
+
+        # bounded queue: if the worker died, fail now instead of blocking or buffering the whole run
+        while True:
+            if self.__error is not None:
+                raise self.__error
+
+            try:
+                self.__queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def __worker(self) -> None:
+
+        last_render = time.time()
+        dirty = False
+
+        try:
+            while True:
+                try:
+                    item = self.__queue.get(timeout=self.render_every)
+                except queue.Empty:
+                    item = ()
+
+                if item is None:
+                    self.__render()
+                    return
+
+                if item:
+                    self.__accumulate(*item)
+                    dirty = True
+
+                if dirty and time.time() - last_render >= self.render_every:
+                    self.__render()
+                    last_render = time.time()
+                    dirty = False
+
+        except Exception as e:
+            self.__error = e
+
+    def __bin(self, roi_pct:np.ndarray) -> np.ndarray:
+
+        idx = np.searchsorted(self.__edges, roi_pct, side="right") - 1
+        
+        return np.clip(idx, 0, len(self.__roi_hist) - 1)
+
+    def __accumulate(self, pnl:float, roi:float, step_roi:np.ndarray) -> None:
+
+        roi_pct = roi * 100
+        self.__roi_hist[self.__bin(roi_pct)] += 1
+        self.__fan_hist[np.arange(len(self.fan_steps)), self.__bin(np.asarray(step_roi) * 100)] += 1
+
+        if roi_pct < self.__edges[0] or roi_pct >= self.__edges[-1]:
+            self.__out_of_range += 1
+
+        self.__pnl_moments += (1, pnl, pnl ** 2)
+        self.__roi_moments += (1, roi_pct, roi_pct ** 2)
+        self.__pnl_min = min(self.__pnl_min, pnl)
+        self.__pnl_max = max(self.__pnl_max, pnl)
+
+    def __quantiles(self, hist:np.ndarray, q:list) -> np.ndarray:
+
+        # linear interpolation inside the bin that crosses each quantile
+        cdf = np.concatenate(([0], np.cumsum(hist))) / max(hist.sum(), 1)
+        
+        return np.interp(q, cdf, self.__edges)
+
+    def __moments(self, moments:np.ndarray) -> tuple[float, float]:
+
+        n, total, total_sq = moments
+        mean = total / n
+        var = (total_sq - n * mean ** 2) / (n - 1) if n > 1 else float("nan")
+
+        return mean, math.sqrt(max(var, 0.0))
+
+    def __render(self) -> None:
+
+        if self.__roi_moments[0] == 0:
+            return
+
+        self.__render_histogram()
+        self.__render_fan()
+        self.__render_html()
+
+    def __save(self, fig:Figure, name:str) -> None:
+
+        # write-then-rename so readers never see a half-written file
+        path = os.path.join(self.out_dir, name)
+        fig.savefig(path + ".tmp", format="png")
+        os.replace(path + ".tmp", path)
+
+    def __render_histogram(self) -> None:
+
+        occupied = np.nonzero(self.__roi_hist)[0]
+        lo, hi = occupied[0], occupied[-1] + 1
+        group = max(1, math.ceil((hi - lo) / self.MAX_DISPLAY_BINS))
+        hist = np.add.reduceat(self.__roi_hist[lo:hi], np.arange(0, hi - lo, group))
+        edges = self.__edges[lo:hi + 1:group]
+        edges = np.append(edges, self.__edges[hi]) if len(edges) == len(hist) else edges
+
+        fig = Figure(figsize=(8, 5))
+        ax = fig.add_subplot()
+        ax.bar(edges[:-1], hist, width=np.diff(edges), align="edge", edgecolor='black')
+        ax.set_title('Histograma de Retornos')
+        ax.set_xlabel('Retorno')
+        ax.set_ylabel('Frequência')
+        self.__save(fig, "roi_histogram.png")
+
+    def __render_fan(self) -> None:
+
+        # trace[k] is taken after step k is revalued, i.e. (k + 1) steps into the run
+        days = (self.fan_steps + 1) * self.__step_days
+        q = sorted({p for band in self.FAN_BANDS for p in band} | {0.5})
+        fan = np.array([self.__quantiles(h, q) for h in self.__fan_hist])
+
+        fig = Figure(figsize=(8, 5))
+        ax = fig.add_subplot()
+
+        for alpha, (low, high) in zip([0.2, 0.4], self.FAN_BANDS):
+            ax.fill_between(days, fan[:, q.index(low)], fan[:, q.index(high)], alpha=alpha, color="tab:blue", 
+                            label=f"{low*100:.0f}%-{high*100:.0f}%")
+
+        ax.plot(days, fan[:, q.index(0.5)], color="tab:blue", label="Mediana")
+        ax.set_title('ROI % por passo')
+        ax.set_xlabel('Dias')
+        ax.set_ylabel('ROI %')
+        ax.legend(loc="upper left")
+        self.__save(fig, "roi_fan.png")
+
+    def __summary_rows(self) -> list[tuple[str, str]]:
+
+        if self.__roi_moments[0] == 0:
+            return [("Paths", "0")]
+
+        roi_mean, roi_std = self.__moments(self.__roi_moments)
+        pnl_mean, pnl_std = self.__moments(self.__pnl_moments)
+        roi_q = self.__quantiles(self.__roi_hist, self.QUANTILES)
+
+        rows = [("Paths", f"{int(self.__roi_moments[0]):,}"),
+                ("P&L mean", f"{pnl_mean:2,.2f}"),
+                ("P&L std", f"{pnl_std:2,.2f}"),
+                ("P&L min", f"{self.__pnl_min:2,.2f}"),
+                ("P&L max", f"{self.__pnl_max:2,.2f}"),
+                ("ROI % mean", f"{roi_mean:2,.2f}"),
+                ("ROI % std", f"{roi_std:2,.2f}")]
+        rows = rows + [(f"ROI % q{q*100:g}", f"{v:2,.2f}") for q, v in zip(self.QUANTILES, roi_q)]
+        rows = rows + [("ROI % outside binned range", f"{self.__out_of_range:,}")]
+
+        return rows
+
+    def __render_html(self) -> None:
+
+        rows = self.__summary_rows()
+
+        _ = ""
+        _ = _ + "<html><head><meta charset='utf-8'><title>Simulation report</title></head><body>" + "\n"
+        _ = _ + f"<h1>Simulation report</h1><p>Updated {time.strftime('%Y-%m-%d %H:%M:%S')}</p>" + "\n"
+        _ = _ + "<table border='1'>" + "".join(f"<tr><td>{k}</td><td>{v}</td></tr>" for k, v in rows) + "</table>" + "\n"
+        _ = _ + "<img src='roi_histogram.png'><img src='roi_fan.png'>" + "\n"
+        _ = _ + "</body></html>" + "\n"
+
+        path = os.path.join(self.out_dir, "report.html")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(_)
+        os.replace(path + ".tmp", path)